@@ -1,11 +1,28 @@
 import argparse
 import logging
+import multiprocessing
 import os
-import time
+import queue
+import threading
 from pathlib import Path
 
 import cv2
+import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Files that are never videos, skipped without opening a VideoCapture on them
+NON_VIDEO_NAMES = {".ds_store", "thumbs.db", "desktop.ini"}
+NON_VIDEO_EXTENSIONS = {
+    ".txt", ".md", ".json", ".xml", ".csv", ".ini", ".log", ".nfo", ".pdf",
+    ".srt", ".vtt", ".ass", ".ssa", ".sub", ".idx",
+    ".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp", ".heic",
+    ".zip", ".tar", ".gz", ".7z", ".rar", ".db", ".tmp", ".part",
+}
 
 def get_videos(root_dir, recursive=False):
     root_dir = Path(root_dir)
@@ -15,20 +32,355 @@ def get_videos(root_dir, recursive=False):
         yield root_dir
         return
 
-    pattern = "**/*" if recursive else "*"
-    for path in root_dir.glob(pattern):
-        if path.is_file():
-            yield path
-        else:
-            logging.warning(f"'{str(path)}' is not a file")
+    # scandir entries cache the file type from readdir so no extra stat per entry
+    dirs = [str(root_dir)]
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                if entry.is_file():
+                    name = entry.name.lower()
+                    if name in NON_VIDEO_NAMES or os.path.splitext(name)[1] in NON_VIDEO_EXTENSIONS:
+                        logging.warning(f"Skip '{entry.path}' since it is not a video file")
+                    else:
+                        yield Path(entry.path)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    logging.warning(f"'{entry.path}' is not a file")
+
+BLUR_CHECK_WIDTH = 480
+NUMBA_MAX_PIXELS = 640 * 360
+BLUR_BATCH_SIZE = 8
+# Same kernel as cv2.Laplacian with ksize=1
+LAPLACIAN_KERNEL = np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]], dtype=np.float32)
+MAX_WORKERS = 4
+# 8-bit planar pixel formats whose raw output starts with the full resolution Y plane
+RAW_LUMA_PIXEL_FORMATS = {"I420", "IYUV", "YV12", "J420", "Y42B", "J422", "444P", "J444", "Y800", "GREY", "NV12", "NV21"}
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def laplacian_var_u8(gray):
+        # Same kernel as cv2.Laplacian with ksize=1 over the pixels off the border,
+        # fused with the variance in one pass.
+        # Single threaded since videos already run in parallel worker processes
+        h, w = gray.shape
+        sum_v = 0
+        sum_v2 = 0
+        for i in range(1, h - 1):
+            for j in range(1, w - 1):
+                v = (int(gray[i, j - 1]) + int(gray[i, j + 1]) + int(gray[i - 1, j]) + int(gray[i + 1, j])
+                     - 4 * int(gray[i, j]))
+                sum_v += v
+                sum_v2 += v * v
+        n = max((h - 2) * (w - 2), 1)
+        mean = sum_v / n
+        return sum_v2 / n - mean * mean
+else:
+    laplacian_var_u8 = None
+
+def get_blur_gray(image, buffers):
+    # Laplacian variance is robust to downsampling, so measure it on a small frame
+    h, w = image.shape[:2]
+    if w > BLUR_CHECK_WIDTH:
+        scale = BLUR_CHECK_WIDTH / w
+        image = buffers["small"] = cv2.resize(image, (0, 0), dst=buffers.get("small"), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # Grayscale frames are already luminance
+    if image.ndim == 2:
+        return image
+
+    buffers["gray"] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=buffers.get("gray"))
+    return buffers["gray"]
+
+def get_pixel_format(cap):
+    # FourCC of the decoder's pixel format (property is missing on older OpenCV)
+    try:
+        code = int(cap.get(cv2.CAP_PROP_CODEC_PIXEL_FORMAT))
+    except AttributeError:
+        return None
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+
+def get_luma(frame, height, width):
+    # Raw output is only usable as luminance when it is 8-bit with the Y plane on top,
+    # either the Y plane alone or all planes stacked (4:2:0, 4:2:2 or 4:4:4)
+    if frame.dtype != np.uint8 or frame.ndim != 2 or frame.shape[1] != width:
+        return None
+    if frame.shape[0] not in (height, height * 3 // 2, height * 2, height * 3):
+        return None
+    return frame[:height]
+
+def laplacian_variance(image, buffers):
+    gray = get_blur_gray(image, buffers)
+    if laplacian_var_u8 is not None and gray.size <= NUMBA_MAX_PIXELS:
+        return laplacian_var_u8(gray)
+
+    # 16-bit integer output is exact for 3x3 kernel on uint8 and hits SIMD kernels
+    lap = buffers["lap"] = cv2.Laplacian(gray, cv2.CV_16S, dst=buffers.get("lap"), ksize=1)
+    # Border pixels are left out, like in the Numba and batch paths, so every path gives the same value
+    _, stddev = cv2.meanStdDev(lap[1:-1, 1:-1])
+    return stddev[0][0] ** 2
+
+def laplacian_vars(batch):
+    # Filter all frames stacked as one tall image, then drop the border pixels of
+    # every frame (where the kernel also mixes pixels of neighbouring frames)
+    b, h, w = batch.shape
+    lap = cv2.filter2D(batch.reshape(b * h, w), cv2.CV_16S, LAPLACIAN_KERNEL).reshape(b, h, w)
+    return lap[:, 1:-1, 1:-1].astype(np.float64).var(axis=(1, 2))
+
+def flush_blur_batch(pending, batch, blur_threshold, writer_q):
+    if not pending:
+        return
 
-def is_blur_image(image, blur_threshold):
-    if blur_threshold is not None:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        l_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+    l_vars = laplacian_vars(batch[:len(pending)])
+    for (frame_count, save_path, image), l_var in zip(pending, l_vars):
         if l_var < blur_threshold:
-            return l_var, True
-    return 0, False
+            logging.info(f"Skip frame {frame_count} since laplacian variance is lower than the threshold ( {l_var} < {blur_threshold} ) [blurry frame]")
+        else:
+            writer_q.put((save_path, image))
+    pending.clear()
+
+def get_write_params(extension, jpeg_quality, png_compression):
+    if extension == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    return [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+
+def write_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def writer_loop(writer_q, extension, write_params):
+    # Encode in memory with a fixed encoder instead of letting imwrite pick it from each path
+    ext = f".{extension}"
+    while True:
+        item = writer_q.get()
+        if item is None:
+            break
+
+        # Any failure only loses this image, the thread must keep draining the queue
+        # or the decoding loop blocks forever on a full queue
+        save_path, image = item
+        try:
+            success, buf = cv2.imencode(ext, image, write_params)
+            if not success:
+                logging.warning(f"Cannot encode '{save_path}'")
+                continue
+
+            write_file(save_path, buf)
+        except Exception as e:
+            logging.warning(f"Cannot save '{save_path}': {e}")
+            continue
+        logging.info(f"Saved '{save_path}'")
+
+def open_video(vid_path, decode_threads):
+    # FFmpeg only applies the decode thread count when the capture is opened
+    # (property and open params are missing on older OpenCV)
+    try:
+        cap = cv2.VideoCapture(str(vid_path), cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, decode_threads])
+    except (AttributeError, TypeError):
+        cap = cv2.VideoCapture(str(vid_path), cv2.CAP_FFMPEG)
+    if cap.isOpened():
+        return cap
+
+    # OpenCV may be built without FFmpeg, let it pick another backend
+    return cv2.VideoCapture(str(vid_path))
+
+def get_output_names(vid_paths, root_dir):
+    # Use the video name as before, but videos sharing a name (e.g. clip.mp4 and clip.avi,
+    # or a/clip.mp4 and b/clip.mp4) get their relative path and extension so outputs don't collide
+    stem_counts = {}
+    for vid_path in vid_paths:
+        stem = vid_path.stem.casefold()
+        stem_counts[stem] = stem_counts.get(stem, 0) + 1
+
+    names = []
+    for vid_path in vid_paths:
+        if stem_counts[vid_path.stem.casefold()] == 1:
+            names.append(vid_path.stem)
+        else:
+            rel_path = vid_path.relative_to(root_dir) if vid_path != Path(root_dir) else Path(vid_path.name)
+            names.append("-".join(rel_path.parent.parts + (vid_path.stem, vid_path.suffix.lstrip("."))))
+
+    if len({name.casefold() for name in names}) != len(names):
+        raise Exception("Cannot give unique output names to videos, rename the conflicting videos")
+    return names
+
+def process_video(vid_path, vid_name, args_dict, decode_threads):
+    args = argparse.Namespace(**args_dict)
+
+    cap = open_video(vid_path, decode_threads)
+    if not cap.isOpened():
+        logging.warning(f"'{str(vid_path)}' is not support video format")
+        return
+
+    # Try to skip color conversion for grayscale output by taking the Y plane of the raw decoder output.
+    # That only works for 8-bit planar formats (10-bit ones come back as garbage 8-bit data),
+    # everything else is retrieved as BGR and converted to gray
+    raw_luma = args.grayscale and get_pixel_format(cap) in RAW_LUMA_PIXEL_FORMATS
+    if raw_luma:
+        raw_luma = cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    logging.info(f"Process '{str(vid_path)}' | FPS: {fps}")
+    total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    duration_ms =  (total_frames / fps) * 1000
+    logging.info(f"Total frames: {total_frames} | Duration: {duration_ms} ms")
+
+    if args.start is not None or args.end is not None:
+
+        if args.start is not None and args.start > duration_ms:
+            raise Exception(f"Start time cannot exceeded the video duration ({duration_ms} ms)")
+
+        if args.end is not None and args.end > duration_ms:
+            raise Exception(f"End time cannot exceeded the video duration ({duration_ms} ms)")
+
+    if args.flat:
+        save_dir = args.output
+        name_prefix = f"{vid_name}-"
+    else:
+        save_dir = os.path.join(args.output, vid_name)
+        name_prefix = ""
+        os.makedirs(save_dir, exist_ok=True)
+
+    # For constant frame rate video the timestamp can be derived from the frame number
+    use_frame_time = args.assume_cfr and fps > 0
+
+    frame_count = -1
+    last_saved_frame = None
+    blur_buffers = {}
+    blur_threshold = args.filter_blur_image
+    blur_enabled = blur_threshold is not None
+    batch_blur = args.batch_blur and blur_enabled
+    blur_batch = None
+    pending = []
+
+    # Seek to the start point instead of decoding every frame before it
+    if args.start is not None and args.start > 0:
+        cap.set(cv2.CAP_PROP_POS_MSEC, args.start)
+        # Seek may land before the requested time, the start check in the loop skips those frames
+        frame_count = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+
+    # Encode and write images on a separate thread so it overlaps with decoding
+    writer_q = queue.Queue(maxsize=8)
+    write_params = get_write_params(args.extension, args.jpeg_quality, args.png_compression)
+    writer = threading.Thread(target=writer_loop, args=(writer_q, args.extension, write_params))
+    writer.start()
+
+    # Bind per-frame calls and options to locals to skip attribute lookups in the loop
+    grab = cap.grab
+    retrieve = cap.retrieve
+    put = writer_q.put
+    start = args.start
+    end = args.end
+    skip_frame = args.skip_frame
+    skip_time = args.skip_time
+    grayscale = args.grayscale
+    image_ext = f".{args.extension}"
+    try:
+        while True:
+            # grab() only demuxes/decodes the frame, retrieve() does the costly
+            # color conversion and copy so it is deferred until the frame is kept
+            if not grab():
+                break
+
+            frame_count+=1
+
+            if use_frame_time:
+                # Multiply before dividing so whole millisecond times come out exact
+                current_time_ms = frame_count * 1000.0 / fps
+            else:
+                current_time_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+
+            if start is not None and current_time_ms < start:
+                continue
+
+            if end is not None:
+                if current_time_ms >= end:
+                    break
+
+            if skip_frame is not None and frame_count % skip_frame != 0:
+                continue
+
+            if skip_time is not None:
+                # Round to microseconds so float error in either timestamp source can't flip the comparison
+                if last_saved_frame is not None and round(current_time_ms - last_saved_frame, 3) < skip_time:
+                    continue
+                else:
+                    last_saved_frame = current_time_ms
+
+            # Only frames that pass the cheap filters above are retrieved and blur checked
+            success, image = retrieve()
+            if not success:
+                break
+
+            if raw_luma:
+                image = get_luma(image, frame_height, frame_width)
+                if image is None:
+                    logging.warning(f"Skip frame {frame_count} since decoder output is not 8-bit luminance")
+                    continue
+            elif grayscale and image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+            # Frame number is unique within a video and vid_name is unique per video,
+            # zero padded so names sort in frame order
+            save_path = os.path.join(save_dir, f"{name_prefix}{frame_count:08d}{image_ext}")
+
+            if batch_blur:
+                # Collect frames and blur check them together once the batch is full
+                gray = get_blur_gray(image, blur_buffers)
+                if blur_batch is None or blur_batch.shape[1:] != gray.shape:
+                    flush_blur_batch(pending, blur_batch, blur_threshold, writer_q)
+                    blur_batch = np.empty((BLUR_BATCH_SIZE, *gray.shape), dtype=np.uint8)
+
+                blur_batch[len(pending)] = gray
+                pending.append((frame_count, save_path, image))
+                if len(pending) == BLUR_BATCH_SIZE:
+                    flush_blur_batch(pending, blur_batch, blur_threshold, writer_q)
+                continue
+
+            if blur_enabled:
+                l_var = laplacian_variance(image, blur_buffers)
+                if l_var < blur_threshold:
+                    logging.info(f"Skip frame {frame_count} since laplacian variance is lower than the threshold ( {l_var} < {blur_threshold} ) [blurry frame]")
+                    continue
+
+            # retrieve() returns a new array for every frame (and the grayscale slice is a view of it),
+            # so the image can be handed to the writer without copying
+            put((save_path, image))
+
+        flush_blur_batch(pending, blur_batch, blur_threshold, writer_q)
+
+    except Exception as e:
+        raise e
+    finally:
+        cap.release()
+        writer_q.put(None)
+        writer.join()
+
+    logging.info(f"Finish process '{str(vid_path)}'")
+
+def process_video_task(task):
+    # A failing video is logged and reported back instead of raised, so the pool
+    # doesn't terminate the other videos mid-extraction
+    vid_path = task[0]
+    try:
+        process_video(*task)
+    except Exception:
+        logging.exception(f"Failed to process '{str(vid_path)}'")
+        return vid_path
+    return None
+
+def setup_logging(verbose):
+    if verbose:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
 
 def positive_int_or_none(value):
     try:
@@ -41,7 +393,7 @@ def positive_int_or_none(value):
     except Exception as e:
         raise e
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser(description="Extract images from directory of videos")
 
     parser.add_argument(
@@ -65,12 +417,32 @@ if __name__ == "__main__":
         default="jpg"
     )
 
+    parser.add_argument(
+        "-jq", "--jpeg-quality",
+        type=int,
+        help="quality of saved jpg image from 0 to 100 (higher is better quality but slower and bigger file). default is 85",
+        default=85
+    )
+
+    parser.add_argument(
+        "-pc", "--png-compression",
+        type=int,
+        help="compression level of saved png image from 0 to 9 (higher is smaller file but slower). default is 1",
+        default=1
+    )
+
     parser.add_argument(
         "-f", "--flat",
         help="save all images from all videos in sigle directory <output_dir>/<image> (normally images will be save in <output_dir>/<video_name>/<image>)",
         action="store_true"
     )
 
+    parser.add_argument(
+        "-g", "--grayscale",
+        help="save grayscale images, taken directly from the decoded luminance for 8-bit video to skip color conversion",
+        action="store_true"
+    )
+
     parser.add_argument(
         "-r", "--recursive",
         help="recursively get all videos under given <video_dir>",
@@ -80,9 +452,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "-fb", "--filter-blur-image",
         nargs="?",
-        const=100,
+        const=700,
         type=int,
-        help="filter blur image using variance of laplacian (smaller the value, more blurry the image). default is 100 if used without value",
+        help="filter blur image using variance of laplacian measured on the frame downscaled to 480 px wide, so the value does not depend on video resolution (smaller the value, more blurry the image). default is 700 if used without value. values from earlier versions need rescaling, their 100 is roughly 700 on 1080p/4K, 500 on 720p and 270 on 480p video",
+    )
+
+    parser.add_argument(
+        "-bb", "--batch-blur",
+        help=f"check blur of {BLUR_BATCH_SIZE} frames at once for better throughput, used with --filter-blur-image",
+        action="store_true"
     )
 
     parser.add_argument(
@@ -119,6 +497,13 @@ if __name__ == "__main__":
         help="set end point of the video to extract images in milisecond"
     )
 
+    parser.add_argument(
+        "--assume-cfr",
+        help="compute frame time from frame number and FPS assuming constant frame rate video. use --no-assume-cfr for variable frame rate video. default is enabled",
+        action=argparse.BooleanOptionalAction,
+        default=True
+    )
+
     parser.add_argument(
         "-v", "--verbose",
         help="enable verbose mode",
@@ -131,6 +516,12 @@ if __name__ == "__main__":
     if not (os.path.isdir(args.video_dir) or os.path.isfile(args.video_dir)):
         raise Exception(f"'{args.video_dir}' is not exist as directory or file")
 
+    if not 0 <= args.jpeg_quality <= 100:
+        raise Exception(f"JPEG quality must be between 0 and 100")
+
+    if not 0 <= args.png_compression <= 9:
+        raise Exception(f"PNG compression must be between 0 and 9")
+
     if args.skip_time is not None and args.skip_frame is not None:
         raise Exception(f"You can choose either to skip frame or time, not both")
 
@@ -140,88 +531,21 @@ if __name__ == "__main__":
     # Initialize
     Path(args.output).mkdir(parents=True, exist_ok=True)
 
-    if args.verbose:
-        logging.basicConfig(level=logging.INFO, format="%(message)s")
-    else:
-        logging.basicConfig(level=logging.WARNING, format="%(message)s")
-
-    for vid_path in get_videos(args.video_dir, args.recursive):
-
-        cap = cv2.VideoCapture(str(vid_path))
-        if not cap.isOpened():
-            logging.warning(f"'{str(vid_path)}' is not support video format")
-            continue
-
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        logging.info(f"Process '{str(vid_path)}' | FPS: {fps}")
-        total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        duration_ms =  (total_frames / fps) * 1000
-        logging.info(f"Total frames: {total_frames} | Duration: {duration_ms} ms")
-
-        if args.start is not None or args.end is not None:
-
-            if args.start is not None and args.start > duration_ms:
-                raise Exception(f"Start time cannot exceeded the video duration ({duration_ms} ms)")
-
-            if args.end is not None and args.end > duration_ms:
-                raise Exception(f"End time cannot exceeded the video duration ({duration_ms} ms)")
-
-        frame_count = -1
-        last_saved_frame = None
-        try:
-            while True:
-                frame_count+=1
-
-                success, image = cap.read()
-                if not success:
-                    break
-
-                current_time_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
-
-                if args.start is not None and current_time_ms < args.start:
-                    continue
-
-                if args.end is not None:
-                    if current_time_ms >= args.end:
-                        break
-
-                if args.skip_time is not None:
-                    if last_saved_frame is not None and (current_time_ms - last_saved_frame) < args.skip_time:
-                        continue
-                    else:
-                        last_saved_frame = current_time_ms
-                    # cap.set(cv2.CAP_PROP_POS_MSEC, (start_frame + frame_count) * args.skip_time) # <- this is very slow
-
-                if args.skip_frame is not None and frame_count % args.skip_frame != 0: 
-                    continue
-
-                l_var, is_blur = is_blur_image(image, args.filter_blur_image)
-                if is_blur:
-                    logging.info(f"Skip frame {frame_count} since laplacian variance is lower than the threshold ( {l_var} < {args.filter_blur_image} ) [blurry frame]")
-                    continue
-
-                vid_name = vid_path.stem
-                image_name = f"{time.time()}-{frame_count}.{args.extension}"
-                save_path = ""
-                if args.flat:
-                    save_path = os.path.join(args.output, f"{vid_name}-{image_name}")
-                else:
-                    save_dir = os.path.join(args.output, vid_name) 
-                    Path(save_dir).mkdir(parents=True, exist_ok=True)
-
-                    save_path = os.path.join(save_dir, image_name)
-
-                cv2.imwrite(save_path, image)
-                logging.info(f"Saved '{save_path}'")
-
-
-        except Exception as e:
-            raise e
-        finally:
-            cap.release()
-
-        logging.info(f"Finish process '{str(vid_path)}'")
-
+    setup_logging(args.verbose)
 
+    vid_paths = list(get_videos(args.video_dir, args.recursive))
+    vid_names = get_output_names(vid_paths, args.video_dir)
+    if vid_paths:
+        # Process videos in parallel, splitting the cores between workers and FFmpeg decode threads
+        processes = min(MAX_WORKERS, os.cpu_count() or 1, len(vid_paths))
+        decode_threads = max(1, (os.cpu_count() or 4) // processes)
+        with multiprocessing.Pool(processes=processes, initializer=setup_logging, initargs=(args.verbose,)) as pool:
+            # One video per task since video lengths vary a lot
+            tasks = [(p, n, vars(args), decode_threads) for p, n in zip(vid_paths, vid_names)]
+            failed = [p for p in pool.imap_unordered(process_video_task, tasks, chunksize=1) if p is not None]
 
+        if failed:
+            raise Exception(f"Failed to process {len(failed)} video(s): {', '.join(str(p) for p in failed)}")
 
+if __name__ == "__main__":
+    main()